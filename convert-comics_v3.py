@@ -1,42 +1,70 @@
 import os
 import shutil
 import zipfile
+import zlib
+import mmap
+import struct
 import rarfile
 import argparse
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from collections import deque
 from tqdm import tqdm
 import logging
-from queue import Queue
-from threading import Lock
+from logging.handlers import QueueHandler, QueueListener
+import multiprocessing
+from queue import Queue, Empty
+from threading import Thread, Event
 import sys
 import pathlib
+import tempfile
+import time
+
+try:
+    import libarchive
+except (ImportError, OSError):
+    # Optional: without libarchive-c (or the libarchive C library) CBRs go through rarfile
+    libarchive = None
 
 """
 This script converts CBR (RAR) and CBZ (ZIP) files into uncompressed CBZ format while preserving the directory structure.
-It uses multithreading for faster processing and includes progress indication.
+It uses multiprocessing for faster processing and includes progress indication.
 
 Dependencies:
-- pip install rarfile tqdm
+- pip install 'rarfile>=3.0' tqdm
 - sudo apt install unrar (Linux only)
 - For Windows, install WinRAR and ensure it's in your PATH
+- Optional: pip install libarchive-c (needs the libarchive library, e.g. sudo apt install libarchive13)
+  to read CBRs in-process instead of through unrar
 
 Usage:
     Basic usage:
         python convert_comics.py /path/to/input/comics /path/to/output/directory
 
-    With specific number of threads:
+    With specific number of worker processes:
         python convert_comics.py /path/to/input/comics /path/to/output/directory --threads 4
 
+    With a specific scratch directory for CBRs that must be extracted to disk:
+        python convert_comics.py /path/to/input/comics /path/to/output/directory --tmpdir /mnt/scratch
+
+    Re-running against the same output skips files that were already converted;
+    add --verify-existing to testzip() those first, or --force to redo everything:
+        python convert_comics.py /path/to/input/comics /path/to/output/directory --force
+
 Features:
     - Processes CBR and CBZ files recursively in the input directory
     - Preserves directory structure in the output
     - Converts all files to uncompressed CBZ format
-    - Multi-threaded processing for improved speed
+    - Multi-process processing for improved speed (log records are funnelled to the main process)
     - Progress bar showing conversion status
+    - Incremental runs: existing non-empty CBZs in the output are skipped by default
     - Detailed error logging to 'conversion.log'
     - Moves problematic files to '_failed' subdirectory
     - Attempts to recover misnamed archives (e.g., CBR files that are actually ZIP)
     - Full Unicode/non-ASCII filename support
+    - Timestamps ZIP can't store (before 1980 or after 2107) are clamped instead of
+      failing the conversion (strict_timestamps=False); the output is never re-tested,
+      since CRCs are computed as it is written
 
 Output Structure:
     output_directory/
@@ -53,13 +81,19 @@ Error Handling:
     - Failed conversions don't stop the script
     - All errors are logged to both console and log file
     - Problematic files are moved to '_failed' directory
+    - Failed files are hard-linked into '_failed' when possible, copied otherwise
     - Temporary files are cleaned up even after errors
+    - Temporary extraction folders go in /dev/shm when writable (Linux), else the system temp dir
 
 Performance Tips:
-    - Default thread count is set to CPU count
-    - For HDDs, using too many threads might slow down processing
-    - For SSDs, higher thread counts generally improve performance
-    - Monitor system resources and adjust thread count as needed
+    - Default worker count is set to CPU count, or 2 when the input or output is on a
+      rotational disk (detected on Linux)
+    - For HDDs, using too many workers might slow down processing
+    - On a rotational input, only one file per source directory is converted at a time
+      (--per-dir-limit); other directories keep the remaining workers busy
+    - For SSDs, higher worker counts generally improve performance
+    - Monitor system resources and adjust worker count as needed
+    - Archive data is copied in 1 MiB blocks; set CBZ_IO_BUFSIZE (bytes) to tune it
 """
 
 # Configure UTF-8 encoding for all platforms
@@ -78,61 +112,198 @@ logging.basicConfig(
     ]
 )
 
-# Shared counters with thread-safe access
-class Counter:
-    def __init__(self):
-        self.lock = Lock()
-        self.processed = 0
-        self.converted = 0
-        self.failed = 0
-    
-    def increment(self, counter_type):
-        with self.lock:
-            if counter_type == 'processed':
-                self.processed += 1
-            elif counter_type == 'converted':
-                self.converted += 1
-            elif counter_type == 'failed':
-                self.failed += 1
+# Block size for copying archive entries (one block usually covers a whole page);
+# at least 1, since a zero-length read would look like the end of an entry
+IO_BUFSIZE = max(1, int(os.environ.get('CBZ_IO_BUFSIZE', 1 << 20)))
+
+# Worker cap when the input or output is on a spinning disk (seeks dominate there)
+ROTATIONAL_WORKERS = 2
+
+# Chunks buffered between the RAR decompressor thread and the CBZ writer
+PIPELINE_DEPTH = 8
+
+# RAR entries below this size are read in one call instead of streamed
+SMALL_ENTRY_SIZE = 64 * 1024
+
+# Errors raised while reading a corrupt or truncated archive
+ARCHIVE_ERRORS = (zipfile.BadZipFile, rarfile.Error, zlib.error, EOFError)
+# The subset that means the data itself is bad (rarfile.RarCRCError is a BadRarFile)
+CORRUPTION_ERRORS = (rarfile.BadRarFile, zipfile.BadZipFile, zlib.error, EOFError)
+# RAR errors that extracting to disk would hit just the same
+NO_DISK_RETRY_ERRORS = CORRUPTION_ERRORS + (rarfile.PasswordRequired, rarfile.NeedFirstVolume)
+
+# Per-file results returned by process_file
+CONVERTED = 'converted'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+def _init_worker(log_queue):
+    """Route a worker process's log records to the main process's handlers."""
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+
+def default_tmpdir():
+    """Pick a scratch directory, preferring RAM-backed /dev/shm on Linux."""
+    if sys.platform.startswith('linux') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
 
-counter = Counter()
+def detect_storage_kind(path):
+    """Guess whether path is on a 'rotational' disk, an 'ssd' or 'tmpfs' (Linux only).
+
+    Returns None when it can't tell (other platforms, network filesystems, ...).
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        real = os.path.realpath(path)
+        # The output directory may not exist yet
+        while not os.path.exists(real):
+            real = os.path.dirname(real)
+        
+        # The longest mount point containing the path gives its filesystem type
+        fstype, mount_len = None, -1
+        with open('/proc/mounts', encoding='utf-8') as mounts:
+            for line in mounts:
+                fields = line.split()
+                mount_point = fields[1].replace('\\040', ' ')
+                if (real == mount_point or real.startswith(mount_point.rstrip('/') + '/')) \
+                        and len(mount_point) > mount_len:
+                    fstype, mount_len = fields[2], len(mount_point)
+        if fstype in ('tmpfs', 'ramfs'):
+            return 'tmpfs'
+        
+        st_dev = os.stat(real).st_dev
+        block_dir = os.path.realpath(f'/sys/dev/block/{os.major(st_dev)}:{os.minor(st_dev)}')
+        # Partitions have no queue/ directory; their parent disk does
+        for dev_dir in (block_dir, os.path.dirname(block_dir)):
+            rotational = os.path.join(dev_dir, 'queue', 'rotational')
+            if os.path.exists(rotational):
+                with open(rotational) as f:
+                    return 'rotational' if f.read().strip() == '1' else 'ssd'
+    except OSError:
+        pass
+    return None
+
+def default_limits(input_dir, output_dir):
+    """Pick (worker count, tasks per source directory) from the storage types.
+
+    Every CPU is used unless the input or output is on a rotational disk; on a
+    rotational input, archives from one directory are read one at a time so
+    the workers don't fight over the same region of the disk. Otherwise the
+    per-directory limit is None (no cap beyond the worker count).
+    """
+    input_kind = detect_storage_kind(input_dir)
+    output_kind = detect_storage_kind(output_dir)
+    workers = os.cpu_count() or 1
+    if 'rotational' in (input_kind, output_kind):
+        workers = min(workers, ROTATIONAL_WORKERS)
+    per_dir = 1 if input_kind == 'rotational' else None
+    logging.info(f"Storage: input {input_kind or 'unknown'}, output {output_kind or 'unknown'}")
+    return workers, per_dir
 
 def safe_path(path):
     """Convert path to pathlib.Path for safe path handling."""
     return pathlib.Path(path)
 
-def is_valid_zip(zip_path):
-    """Check if a ZIP file is valid."""
+def quarantine(src_file, failed_path):
+    """Place a copy of a failed source file in the '_failed' tree.
+
+    A hard link is used when both paths are on the same filesystem, which
+    avoids copying the whole archive; otherwise the file is copied.
+    """
+    failed_path = safe_path(failed_path)
+    failed_path.parent.mkdir(parents=True, exist_ok=True)
+    # Drop a leftover from a previous run (possibly a link to src_file itself)
+    failed_path.unlink(missing_ok=True)
     try:
-        with zipfile.ZipFile(str(zip_path), 'r') as z:
-            return z.testzip() is None
-    except (zipfile.BadZipFile, Exception) as e:
-        logging.error(f"Error checking ZIP file {zip_path}: {str(e)}")
-        return False
+        os.link(str(src_file), str(failed_path))
+    except OSError:
+        # Cross-device or not supported by the filesystem
+        shutil.copy2(src_file, failed_path)
+
+def is_zip_signature(path):
+    """Check the magic bytes of a file for a ZIP local header (or empty ZIP)."""
+    with open(str(path), 'rb') as f:
+        return f.read(4) in (b'PK\x03\x04', b'PK\x05\x06')
 
-def is_valid_rar(rar_path):
-    """Check if a RAR file is valid."""
+def open_archive(src_file):
+    """Open a CBR/CBZ once, trusting the magic bytes over the extension for misnamed CBRs."""
+    if os.path.splitext(src_file)[1].lower() == '.cbr' and not is_zip_signature(src_file):
+        return rarfile.RarFile(src_file, 'r')
+    return zipfile.ZipFile(src_file, 'r', strict_timestamps=False)
+
+def check_archive(archive, src_file):
+    """Run a full CRC pass over an open archive and log the first broken entry."""
     try:
-        with rarfile.RarFile(str(rar_path), 'r') as r:
-            return r.testrar() is None
-    except (rarfile.BadRarFile, Exception) as e:
-        logging.error(f"Error checking RAR file {rar_path}: {str(e)}")
-        return False
+        if isinstance(archive, rarfile.RarFile):
+            archive.testrar()
+        else:
+            bad_entry = archive.testzip()
+            if bad_entry is not None:
+                logging.error(f"Bad CRC for {bad_entry} in {src_file}")
+    except Exception as e:
+        logging.error(f"Error checking {src_file}: {str(e)}")
+
+def can_copy_as_is(archive):
+    """Check whether an open ZIP could be copied byte for byte as the output CBZ.
+
+    Every entry must be an unencrypted, already uncompressed file whose name
+    stream_repack would keep unchanged; anything else has to be repacked.
+    """
+    return all(info.compress_type == zipfile.ZIP_STORED
+               and not info.is_dir()
+               and not info.flag_bits & 0x1
+               and sanitize_arcname(decode_filename(info.filename)) == info.filename
+               for info in archive.infolist())
+
+def verify_stored_crcs(archive, src_file):
+    """CRC-check every entry of a ZIP accepted by can_copy_as_is straight from a memory map.
+
+    The page data is hashed in place, without read() calls or copies; a
+    mismatch raises zipfile.BadZipFile like reading the entry would.
+    """
+    with open(str(src_file), 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for info in archive.infolist():
+            header = mm[info.header_offset:info.header_offset + 30]
+            if header[:4] != b'PK\x03\x04':
+                raise zipfile.BadZipFile(f"Bad local header for file {info.filename!r}")
+            name_len, extra_len = struct.unpack('<HH', header[26:30])
+            start = info.header_offset + 30 + name_len + extra_len
+            with memoryview(mm)[start:start + info.compress_size] as data:
+                crc = zlib.crc32(data)
+            if crc != info.CRC:
+                raise zipfile.BadZipFile(f"Bad CRC-32 for file {info.filename!r}")
+
+def decode_filename(filename):
+    """Recover UTF-8 names that zipfile decoded as cp437."""
+    try:
+        return filename.encode('cp437').decode('utf-8')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return filename
+
+def sanitize_arcname(filename):
+    """Normalise an entry name for the output CBZ, dropping absolute and '.'/'..' parts.
+
+    Returns an empty string if nothing usable is left.
+    """
+    parts = pathlib.PurePosixPath(filename.replace('\\', '/')).parts
+    return '/'.join(part for part in parts if part not in ('/', '.', '..'))
 
 def safe_extract(archive, temp_dir):
-    """Safely extract archive handling potential encoding issues."""
+    """Safely extract archive handling potential encoding issues.
+
+    Only used by the disk fallback; streamed entries never touch the filesystem
+    and are sanitized with sanitize_arcname instead.
+    """
     for info in archive.infolist():
         try:
             # Handle potentially corrupted filenames
-            try:
-                # Try UTF-8 first
-                filename = info.filename.encode('cp437').decode('utf-8')
-            except UnicodeEncodeError:
-                # If that fails, try the original filename
-                filename = info.filename
-            except UnicodeDecodeError:
-                # If both fail, try cp437
-                filename = info.filename.encode('cp437').decode('cp437')
+            filename = decode_filename(info.filename)
                 
             # Convert filename to pathlib.Path for safe handling
             target_path = safe_path(temp_dir) / filename
@@ -151,139 +322,433 @@ def safe_extract(archive, temp_dir):
             logging.error(f"Error extracting {info.filename}: {str(e)}")
             raise
 
-def convert_to_cbz(src_file, dest_file, failed_path):
-    """Convert a CBR or CBZ file into an uncompressed CBZ file."""
-    src_file = safe_path(src_file)
-    dest_file = safe_path(dest_file)
-    failed_path = safe_path(failed_path)
-    temp_dir = safe_path(str(dest_file) + "_temp")
+def zip_date_time(date_time):
+    """Clamp a (year, month, day, hour, min, sec) tuple to the 1980-2107 range ZIP can store."""
+    return min(max(tuple(date_time[:6]), (1980, 1, 1, 0, 0, 0)), (2107, 12, 31, 23, 59, 58))
+
+def stored_zipinfo(info, arcname):
+    """Build the uncompressed ZipInfo for a source ZIP/RAR entry, keeping its metadata.
+
+    Knowing file_size up front lets zipfile size the local header correctly
+    without re-reading or stat'ing anything.
+    """
+    zinfo = zipfile.ZipInfo(arcname, date_time=zip_date_time(info.date_time))
+    zinfo.compress_type = zipfile.ZIP_STORED
+    zinfo.file_size = info.file_size
+    if isinstance(info, zipfile.ZipInfo):
+        # external_attr only means something for the system that wrote it
+        zinfo.create_system = info.create_system
+        zinfo.external_attr = info.external_attr
+    return zinfo
+
+def stream_repack(src_archive, dest_zip):
+    """Copy every file entry of an open ZIP archive straight into dest_zip, uncompressed."""
+    for info in src_archive.infolist():
+        if info.is_dir():
+            continue
+        arcname = sanitize_arcname(decode_filename(info.filename))
+        if not arcname:
+            logging.warning(f"Skipping entry with unusable name: {info.filename!r}")
+            continue
+        with src_archive.open(info) as src, \
+                dest_zip.open(stored_zipinfo(info, arcname), 'w') as dst:
+            shutil.copyfileobj(src, dst, length=IO_BUFSIZE)
+
+def rar_entries(rf):
+    """Yield (ZipInfo, chunk) pieces for every file entry of an open RarFile.
+
+    Each entry starts with its ZipInfo, followed by (None, chunk) pairs.
+    Entries are streamed through rf.open in IO_BUFSIZE chunks, so memory
+    stays bounded however large the page; tiny ones are read in one go.
+    """
+    for info in rf.infolist():
+        if info.is_dir():
+            continue
+        arcname = sanitize_arcname(decode_filename(info.filename))
+        if not arcname:
+            logging.warning(f"Skipping entry with unusable name: {info.filename!r}")
+            continue
+        zinfo = stored_zipinfo(info, arcname)
+        if info.file_size < SMALL_ENTRY_SIZE:
+            yield zinfo, rf.read(info)
+            continue
+        yield zinfo, b''
+        with rf.open(info) as src:
+            while True:
+                chunk = src.read(IO_BUFSIZE)
+                if not chunk:
+                    break
+                yield None, chunk
+
+def libarchive_entries(src_file):
+    """Yield (ZipInfo, chunk) pieces for every file entry of a RAR, decoded through libarchive.
+
+    Same layout as rar_entries. libarchive decodes RAR in-process and reads
+    the archive sequentially, so there is no unrar subprocess per entry (or
+    per archive).
+    """
+    with libarchive.file_reader(str(src_file), block_size=IO_BUFSIZE) as entries:
+        for entry in entries:
+            if not entry.isfile:
+                continue
+            pathname = entry.pathname
+            if not isinstance(pathname, str):
+                # libarchive can't decode the name in this locale (e.g. LC_ALL=C); rarfile can
+                raise libarchive.ArchiveError(f"Undecodable entry name: {pathname!r}")
+            arcname = sanitize_arcname(pathname)
+            if not arcname:
+                logging.warning(f"Skipping entry with unusable name: {pathname!r}")
+                continue
+            mtime = entry.mtime if entry.mtime is not None else time.time()
+            zinfo = zipfile.ZipInfo(arcname, date_time=zip_date_time(time.localtime(mtime)))
+            zinfo.compress_type = zipfile.ZIP_STORED
+            # None when the header doesn't record it; pipelined_repack handles that
+            zinfo.file_size = entry.size
+            yield zinfo, b''
+            for block in entry.get_blocks(block_size=IO_BUFSIZE):
+                yield None, block
+
+def pipelined_repack(entries, dest_zip):
+    """Write the (ZipInfo, chunk) pieces of entries into dest_zip while a thread produces them.
+
+    A piece with a ZipInfo starts a new entry; (None, chunk) continues it.
+    A ZipInfo whose file_size is None (not known up front) gets zip64
+    headers, since the entry may turn out to be larger than 4 GiB.
+    Decompression runs in the producer thread and CRC/writing in this one, so
+    the two overlap; the bounded queue caps memory at PIPELINE_DEPTH chunks.
+    Errors raised by the producer are re-raised here.
+    """
+    done = object()
+    pending = Queue(maxsize=PIPELINE_DEPTH)
+    stop = Event()
+    errors = []
+    
+    def produce():
+        try:
+            for item in entries:
+                if stop.is_set():
+                    break
+                pending.put(item)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            entries.close()
+            pending.put(done)
     
+    producer = Thread(target=produce, daemon=True)
+    producer.start()
+    writer = None
     try:
-        temp_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Extract files based on archive type
-        if src_file.suffix.lower() == '.cbr':
+        while True:
+            item = pending.get()
+            if item is done:
+                break
+            zinfo, chunk = item
+            if zinfo is not None:
+                if writer is not None:
+                    writer.close()
+                size_unknown = zinfo.file_size is None
+                if size_unknown:
+                    zinfo.file_size = 0
+                writer = dest_zip.open(zinfo, 'w', force_zip64=size_unknown)
+            writer.write(chunk)
+        if writer is not None:
+            writer.close()
+            writer = None
+    finally:
+        # On error, release the ZIP (the .part file is discarded anyway) and
+        # unblock the producer so it can close the source
+        if writer is not None:
             try:
-                with rarfile.RarFile(str(src_file), 'r') as rf:
-                    safe_extract(rf, temp_dir)
-            except Exception as e:
-                logging.error(f"Error extracting RAR {src_file}: {str(e)}")
-                # Try opening as a ZIP file in case of misnamed CBR
+                writer.close()
+            except Exception:
+                pass
+        stop.set()
+        while producer.is_alive():
+            try:
+                pending.get(timeout=0.1)
+            except Empty:
+                pass
+        producer.join()
+    if errors:
+        raise errors[0]
+
+def open_cbz(path):
+    """Open a new uncompressed CBZ for writing."""
+    return zipfile.ZipFile(str(path), 'w', compression=zipfile.ZIP_STORED, allowZip64=True,
+                           strict_timestamps=False)
+
+def disk_repack(src_archive, dest_zip, temp_dir):
+    """Extract to temp_dir and repack from disk, for archives that can't be streamed."""
+    safe_extract(src_archive, temp_dir)
+    for file_path in temp_dir.rglob('*'):
+        if file_path.is_file():
+            arcname = str(file_path.relative_to(temp_dir))
+            dest_zip.write(file_path, arcname)
+
+def convert_to_cbz(archive, src_file, dest_file, failed_path, tmpdir=None):
+    """Convert an open CBR or CBZ archive into an uncompressed CBZ file, returning CONVERTED or FAILED.
+
+    Entries are streamed into '<dest_file>.part' (CRCs are checked on the way)
+    and the result is renamed into place; CBRs only go through tmpdir when they
+    can't be streamed, and clean stored CBZs are copied as-is.
+    """
+    part_file = dest_file + '.part'
+    temp_dir = None
+    
+    try:
+        if isinstance(archive, rarfile.RarFile):
+            repacked = False
+            if libarchive is not None:
+                try:
+                    with open_cbz(part_file) as new_zip:
+                        pipelined_repack(libarchive_entries(src_file), new_zip)
+                    repacked = True
+                except libarchive.ArchiveError as e:
+                    logging.warning(f"libarchive could not read {src_file}, retrying with rarfile: {str(e)}")
+            if not repacked:
                 try:
-                    if is_valid_zip(src_file):
-                        with zipfile.ZipFile(str(src_file), 'r') as zf:
-                            safe_extract(zf, temp_dir)
-                    else:
-                        raise Exception("Not a valid ZIP file either")
-                except Exception as ze:
-                    logging.error(f"Failed to process as ZIP: {str(ze)}")
-                    failed_path.parent.mkdir(parents=True, exist_ok=True)
-                    shutil.copy2(src_file, failed_path)
-                    if temp_dir.exists():
-                        shutil.rmtree(temp_dir)
-                    counter.increment('failed')
-                    return False
+                    with open_cbz(part_file) as new_zip:
+                        pipelined_repack(rar_entries(archive), new_zip)
+                except ARCHIVE_ERRORS as e:
+                    if isinstance(e, NO_DISK_RETRY_ERRORS):
+                        # Bad data, passwords and split volumes fail on disk too
+                        raise
+                    logging.error(f"Error streaming RAR {src_file}: {str(e)}")
+                    # Let unrar extract the whole archive to disk, then repack
+                    temp_dir = safe_path(tempfile.mkdtemp(dir=tmpdir, prefix='ccv3-'))
+                    with open_cbz(part_file) as new_zip:
+                        disk_repack(archive, new_zip, temp_dir)
+        elif os.path.splitext(src_file)[1].lower() == '.cbz' and can_copy_as_is(archive):
+            # Already what we'd write: check the CRCs in place, then copy the bytes as-is
+            verify_stored_crcs(archive, src_file)
+            shutil.copyfile(src_file, part_file)
         else:
-            try:
-                with zipfile.ZipFile(str(src_file), 'r') as zf:
-                    safe_extract(zf, temp_dir)
-            except Exception as e:
-                logging.error(f"Error extracting ZIP {src_file}: {str(e)}")
-                failed_path.parent.mkdir(parents=True, exist_ok=True)
-                shutil.copy2(src_file, failed_path)
-                if temp_dir.exists():
-                    shutil.rmtree(temp_dir)
-                counter.increment('failed')
-                return False
-        
-        # Repack extracted files into an uncompressed CBZ archive
-        try:
-            with zipfile.ZipFile(str(dest_file), 'w', compression=zipfile.ZIP_STORED) as new_zip:
-                for file_path in temp_dir.rglob('*'):
-                    if file_path.is_file():
-                        arcname = str(file_path.relative_to(temp_dir))
-                        new_zip.write(file_path, arcname)
-            counter.increment('converted')
-            return True
-        except Exception as e:
-            logging.error(f"Error creating new ZIP {dest_file}: {str(e)}")
-            failed_path.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(src_file, failed_path)
-            counter.increment('failed')
-            return False
+            with open_cbz(part_file) as new_zip:
+                stream_repack(archive, new_zip)
+        os.replace(part_file, dest_file)
+        return CONVERTED
     except Exception as e:
-        logging.error(f"Unexpected error processing {src_file}: {str(e)}")
-        failed_path.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy2(src_file, failed_path)
-        counter.increment('failed')
-        return False
+        logging.error(f"Error converting {src_file}: {str(e)}")
+        if isinstance(e, ARCHIVE_ERRORS):
+            # Full CRC pass only on failure, to log which entry is broken
+            check_archive(archive, src_file)
+        # Don't leave a half-written CBZ behind
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        quarantine(src_file, failed_path)
+        return FAILED
     finally:
         # Clean up temporary extraction folder
-        if temp_dir.exists():
+        if temp_dir is not None and temp_dir.exists():
             shutil.rmtree(temp_dir)
 
+def find_archives(root):
+    """Yield (relative directory, file name) for each CBR/CBZ under root.
+
+    Uses os.scandir so only matching entries are turned into paths, and
+    doesn't descend into symlinked directories (like Path.rglob).
+    """
+    stack = [(str(root), '')]
+    while stack:
+        dir_path, rel_dir = stack.pop()
+        try:
+            entries = os.scandir(dir_path)
+        except OSError as e:
+            # Like rglob, skip directories we can't list instead of aborting the walk
+            logging.warning(f"Skipping unreadable directory {dir_path}: {str(e)}")
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        stack.append((entry.path, os.path.join(rel_dir, entry.name)))
+                elif os.path.splitext(entry.name)[1].lower() in ('.cbz', '.cbr') and entry.is_file():
+                    yield rel_dir, entry.name
+
+def is_converted(dest_file):
+    """Check whether a previous run already produced dest_file.
+
+    Any non-empty file counts (outputs are renamed into place only once
+    complete); this is just a stat, cheap enough for the main process.
+    """
+    try:
+        return os.stat(dest_file).st_size > 0
+    except OSError:
+        return False
+
+def is_valid_output(dest_file):
+    """Run testzip() on an existing CBZ, logging why it will be reconverted if it fails."""
+    try:
+        with zipfile.ZipFile(dest_file, 'r') as z:
+            bad_entry = z.testzip()
+        if bad_entry is not None:
+            logging.warning(f"Reconverting {dest_file}: bad CRC for {bad_entry}")
+        return bad_entry is None
+    except Exception as e:
+        logging.warning(f"Reconverting {dest_file}: {str(e)}")
+        return False
+
 def process_file(args):
-    """Process a single file (for use with ThreadPoolExecutor)."""
-    src_file, dest_file, failed_path = [safe_path(p) for p in args]
-    counter.increment('processed')
-    
-    # Validate and convert files
-    if src_file.suffix.lower() == '.cbz':
-        if not is_valid_zip(src_file):
-            failed_path.parent.mkdir(parents=True, exist_ok=True)
-            shutil.copy2(src_file, failed_path)
-            counter.increment('failed')
-            return False
-    elif src_file.suffix.lower() == '.cbr':
-        if not is_valid_rar(src_file):
-            if not is_valid_zip(src_file):
-                failed_path.parent.mkdir(parents=True, exist_ok=True)
-                shutil.copy2(src_file, failed_path)
-                counter.increment('failed')
-                return False
+    """Process a single file (for use with ProcessPoolExecutor).
+
+    With verify set, dest_file already exists: it is tested first and the
+    file is only reconverted if that fails.
+    """
+    src_file, dest_file, failed_path, tmpdir, verify = args
+    if verify and is_valid_output(dest_file):
+        return SKIPPED
     
-    return convert_to_cbz(src_file, dest_file, failed_path)
+    # Open the source once; the same handle is used for every step
+    try:
+        archive = open_archive(src_file)
+    except Exception as e:
+        logging.error(f"Error opening {src_file}: {str(e)}")
+        quarantine(src_file, failed_path)
+        return FAILED
+    with archive:
+        return convert_to_cbz(archive, src_file, dest_file, failed_path, tmpdir)
 
-def process_files(input_dir, output_dir, max_workers=None):
-    """Process all CBR/CBZ files in the input directory recursively using multiple threads."""
-    input_dir = safe_path(input_dir)
-    output_dir = safe_path(output_dir)
-    failed_dir = output_dir / "_failed"
+def process_files(input_dir, output_dir, max_workers=None, tmpdir=None,
+                  skip_existing=True, verify_existing=False, per_dir_limit=None):
+    """Process all CBR/CBZ files in the input directory recursively using multiple processes."""
+    input_dir = os.fspath(input_dir)
+    output_dir = os.fspath(output_dir)
+    failed_dir = os.path.join(output_dir, "_failed")
+    tmpdir = tmpdir or default_tmpdir()
+    default_workers, default_per_dir = default_limits(input_dir, output_dir)
+    if max_workers is None:
+        max_workers = default_workers
+    if per_dir_limit is None:
+        per_dir_limit = max_workers if default_per_dir is None else default_per_dir
+    logging.info(f"Using {max_workers} worker processes, at most {per_dir_limit} per source directory")
     
     # Collect all files to process
     files_to_process = []
-    for src_file in input_dir.rglob('*'):
-        if src_file.suffix.lower() in ('.cbz', '.cbr'):
-            rel_path = src_file.relative_to(input_dir)
-            dest_path = output_dir / rel_path.parent
-            failed_path = failed_dir / rel_path
-            dest_file = dest_path / (src_file.stem + ".cbz")
-            dest_path.mkdir(parents=True, exist_ok=True)
-            files_to_process.append((str(src_file), str(dest_file), str(failed_path)))
+    created_dirs = set()
+    skipped = 0
+    for rel_dir, name in find_archives(input_dir):
+        # Plain strings all the way down; workers never need Path objects
+        src_file = os.path.join(input_dir, rel_dir, name)
+        dest_path = os.path.join(output_dir, rel_dir)
+        failed_path = os.path.join(failed_dir, rel_dir, name)
+        dest_file = os.path.join(dest_path, os.path.splitext(name)[0] + ".cbz")
+        verify = False
+        if skip_existing and is_converted(dest_file):
+            if not verify_existing:
+                skipped += 1
+                continue
+            # testzip() is as slow as a conversion read; leave it to the workers
+            verify = True
+        # One mkdir per output directory, not per file
+        if dest_path not in created_dirs:
+            os.makedirs(dest_path, exist_ok=True)
+            created_dirs.add(dest_path)
+        files_to_process.append((src_file, dest_file, failed_path, tmpdir, verify))
     
-    # Process files using ThreadPoolExecutor
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(process_file, args) for args in files_to_process]
-        
-        # Show progress bar
-        with tqdm(total=len(files_to_process), desc="Converting files") as pbar:
-            for future in as_completed(futures):
+    # Worker processes log through a queue; the listener writes with our handlers
+    log_queue = multiprocessing.Queue()
+    listener = QueueListener(log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+    listener.start()
+    
+    # Counters are only touched here, so they need no locking
+    processed = converted = failed = 0
+    
+    # Process files using ProcessPoolExecutor
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                 initargs=(log_queue,)) as executor:
+            # Files wait in per-directory queues; only per_dir_limit of them from
+            # any one source directory are submitted at a time
+            waiting = {}
+            for args in files_to_process:
+                waiting.setdefault(os.path.dirname(args[0]), deque()).append(args)
+            running = {}
+            broken = []
+            
+            def submit_next(directory):
+                if not waiting[directory] or broken:
+                    return
                 try:
-                    future.result()
-                except Exception as e:
-                    logging.error(f"Unexpected error in thread: {str(e)}")
-                pbar.update(1)
+                    future = executor.submit(process_file, waiting[directory][0])
+                except BrokenProcessPool as e:
+                    # A worker died and the pool takes no new work; the files
+                    # still waiting are counted as failed once the rest finish
+                    logging.error(f"Worker pool broke, not starting the remaining files: {str(e)}")
+                    broken.append(e)
+                    return
+                waiting[directory].popleft()
+                running[future] = directory
+            
+            for directory in waiting:
+                for _ in range(per_dir_limit):
+                    submit_next(directory)
+            
+            # Show progress bar, updated in batches (~200 refreshes per run at most)
+            batch = max(1, len(files_to_process) // 200)
+            with tqdm(total=len(files_to_process), desc="Converting files",
+                      mininterval=0.5, miniters=batch, smoothing=0) as pbar:
+                done = 0
+                while running:
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        submit_next(running.pop(future))
+                        try:
+                            status = future.result()
+                        except Exception as e:
+                            logging.error(f"Unexpected error in worker: {str(e)}")
+                            status = FAILED
+                        processed += status != SKIPPED
+                        converted += status == CONVERTED
+                        failed += status == FAILED
+                        skipped += status == SKIPPED
+                        done += 1
+                        if done >= batch:
+                            pbar.set_postfix(converted=converted, failed=failed, skipped=skipped, refresh=False)
+                            pbar.update(done)
+                            done = 0
+                lost = sum(len(queue) for queue in waiting.values())
+                processed += lost
+                failed += lost
+                done += lost
+                if done:
+                    pbar.set_postfix(converted=converted, failed=failed, skipped=skipped, refresh=False)
+                    pbar.update(done)
+    finally:
+        listener.stop()
     
     # Summary
-    logging.info(f"Processing complete: {counter.processed} files processed")
-    logging.info(f"Converted: {counter.converted}, Failed: {counter.failed}")
+    logging.info(f"Processing complete: {processed} files processed")
+    logging.info(f"Converted: {converted}, Failed: {failed}, Skipped (already converted): {skipped}")
+
+def positive_int(value):
+    """argparse type for counts that must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
 
 if __name__ == "__main__":
     # Command-line argument parsing
     parser = argparse.ArgumentParser(description="Convert CBR/CBZ to uncompressed CBZ while preserving directory structure.")
     parser.add_argument("input_dir", help="Input directory containing CBR/CBZ files")
     parser.add_argument("output_dir", help="Output directory for processed files")
-    parser.add_argument("--threads", type=int, help="Number of worker threads (default: CPU count)", default=None)
+    parser.add_argument("--threads", type=positive_int, help="Number of worker processes (default: CPU count, "
+                        "or 2 if input/output is on a rotational disk)", default=None)
+    parser.add_argument("--per-dir-limit", type=positive_int, default=None,
+                        help="Max files converted at once from one source directory "
+                             "(default: 1 if the input is on a rotational disk, else no limit)")
+    parser.add_argument("--tmpdir", help="Scratch directory for CBRs that must be extracted to disk "
+                        "(default: /dev/shm if writable, else the system temp directory)", default=None)
+    parser.add_argument("--skip-existing", action=argparse.BooleanOptionalAction, default=True,
+                        help="Skip files whose CBZ already exists in the output directory (default: on)")
+    parser.add_argument("--verify-existing", action="store_true",
+                        help="Run testzip() on existing CBZs before skipping them; reconvert broken ones")
+    parser.add_argument("--force", action="store_true",
+                        help="Reconvert every file, even if its CBZ exists (same as --no-skip-existing)")
     args = parser.parse_args()
     
-    process_files(args.input_dir, args.output_dir, args.threads)
+    process_files(args.input_dir, args.output_dir, args.threads, args.tmpdir,
+                  skip_existing=args.skip_existing and not args.force,
+                  verify_existing=args.verify_existing,
+                  per_dir_limit=args.per_dir_limit)